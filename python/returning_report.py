@@ -1,17 +1,21 @@
 #!/usr/bin/env python3
 
 import argparse
-import collections
 import csv
 import datetime
 import functools
+import hashlib
+import inspect
+import json
 import os
+import sqlite3
 import sys
 
 import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'supporters.settings')
 django.setup()
+from django.db import models
 from supporters.models import Date, Payment, Supporter
 
 MONTH_FMT = '%Y-%m'
@@ -22,40 +26,143 @@ def parse_arguments(arglist):
         description="Print a CSV report showing Supporters who returned",
     )
     month_date = functools.partial(Date.strptime, fmt=MONTH_FMT)
+    first_payment_date = Payment.objects.aggregate(first=models.Min('date'))['first']
+    if first_payment_date is not None:
+        first_payment_date = Date.from_pydate(first_payment_date)
     parser.add_argument(
         '--start-month', type=month_date, metavar='YYYY-MM',
-        default=Payment.objects.order_by('date').first().date,
+        default=first_payment_date,
         help="First month in report")
     parser.add_argument(
         '--end-month', type=month_date, metavar='YYYY-MM',
         default=Date.today(),
         help="Last month in report")
+    parser.add_argument(
+        '--cache', metavar='PATH',
+        help="""SQLite file to cache report rows in, like
+        ~/.cache/returning_report.sqlite.  A cached row is reused until the
+        payments dated on or before its month change.  Checking that still
+        reads every payment, so the cache saves the status calculations,
+        not the database scan.  By default, nothing is cached.""")
     args = parser.parse_args(arglist)
+    if args.start_month is None:
+        parser.error("No payments loaded; --start-month is required")
     if args.end_month < args.start_month:
         parser.error("End month predates start month")
     return args
 
-def report_month(month):
-    annuals = collections.Counter(Supporter(name).status(month)
-                                  for name in Supporter.iter_entities(['Annual']))
-    monthlies = collections.Counter(Supporter(name).status(month)
-                                    for name in Supporter.iter_entities(['Monthly']))
-    eannuals = collections.Counter(
-               min((Supporter(name).months_expired_at_return(month) + 2) // 3, 5)
-               for name in Supporter.iter_entities(['Annual']))
-    emonthlies = collections.Counter(
-                 min((Supporter(name).months_expired_at_return(month) + 2) // 3, 5)
-                 for name in Supporter.iter_entities(['Monthly']))
-    return ((month.strftime(MONTH_FMT),)
-            + ((annuals + monthlies)[Supporter.STATUS_NEW],)
-            + ((eannuals + emonthlies)[1],)
-            + ((eannuals + emonthlies)[2],)
-            + ((eannuals + emonthlies)[3],)
-            + ((eannuals + emonthlies)[4],)
-            + ((eannuals + emonthlies)[5],))
+@functools.lru_cache(maxsize=256)
+def _fmt_month(year, month):
+    return '%04d-%02d' % (year, month)
+
+def report_month(month, payments_by_entity):
+    new_count = 0
+    expired_counts = [0] * 6
+    statuses = Supporter.status_for_all(month, payments_by_entity)
+    # Like status_report.py, count everyone who's ever paid as an Annual
+    # supporter, then everyone who's ever paid as a Monthly supporter, even
+    # if that counts some supporters twice.
+    for supporter_types in (['Annual'], ['Monthly']):
+        for name in Supporter.iter_entities(supporter_types):
+            try:
+                _, status, months_expired = statuses[name]
+            except KeyError:
+                continue  # no payments yet as of this month
+            if status == Supporter.STATUS_NEW:
+                new_count += 1
+            expired_counts[min((months_expired + 2) // 3, 5)] += 1
+    return (_fmt_month(month.year, month.month), new_count) + tuple(expired_counts[1:])
+
+def iter_months(start_month, end_month):
+    month = Date.from_pydate(start_month)
+    while month <= end_month:
+        yield month
+        month = month.round_month_up()
+
+class ReportCache:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.db = sqlite3.connect(path)
+        self.db.execute("""CREATE TABLE IF NOT EXISTS report_rows (
+            month TEXT, version TEXT, fingerprint TEXT, row TEXT,
+            PRIMARY KEY (month, version))""")
+        self.version = self.code_version()
+        with self.db:
+            self.db.execute("DELETE FROM report_rows WHERE version != ?", (self.version,))
+
+    # Rows are only reused by the code that computed them.  The version
+    # hashes this script and supporters/models.py, where Supporter's
+    # business rules live, so changing either one ignores old rows.
+    @staticmethod
+    def code_version():
+        digest = hashlib.sha256()
+        for path in (__file__, inspect.getsourcefile(Supporter)):
+            with open(path, 'rb') as source:
+                digest.update(source.read())
+        return digest.hexdigest()
+
+    # Yield (month, fingerprint) for each of the given months, in order.  A
+    # month's row depends on which entities report_month counts, and every
+    # payment dated on or before the month.  The fingerprint hashes all of
+    # that, so it changes whenever the row might.
+    @staticmethod
+    def iter_fingerprints(months):
+        digest = hashlib.sha256()
+        for supporter_types in (['Annual'], ['Monthly']):
+            entities = sorted(Supporter.iter_entities(supporter_types))
+            digest.update(json.dumps(entities).encode('utf-8'))
+            digest.update(b'\n')
+        # Order same-day payments the way Supporter does, since that order
+        # decides supporter types.
+        payments = iter(Payment.objects
+                        .filter(date__lte=months[-1])
+                        .order_by('date', 'entity', 'id')
+                        .values_list('date', 'entity', 'program'))
+        payment = next(payments, None)
+        for month in months:
+            while (payment is not None) and (payment[0] <= month):
+                date, entity, program = payment
+                digest.update(json.dumps([date.isoformat(), entity, program]).encode('utf-8'))
+                digest.update(b'\n')
+                payment = next(payments, None)
+            yield month, digest.hexdigest()
+
+    def get(self, month, fingerprint):
+        found = self.db.execute(
+            """SELECT row FROM report_rows
+            WHERE month = ? AND version = ? AND fingerprint = ?""",
+            (month.isoformat(), self.version, fingerprint),
+        ).fetchone()
+        if found is None:
+            return None
+        return tuple(json.loads(found[0]))
+
+    def put(self, month, fingerprint, row):
+        with self.db:
+            self.db.execute(
+                "INSERT OR REPLACE INTO report_rows VALUES (?, ?, ?, ?)",
+                (month.isoformat(), self.version, fingerprint, json.dumps(row)))
+
+def iter_report_rows(start_month, end_month, cache=None):
+    months = list(iter_months(start_month, end_month))
+    if cache is None:
+        fingerprints = ((month, None) for month in months)
+    else:
+        fingerprints = cache.iter_fingerprints(months)
+    payments_by_entity = None
+    for month, fingerprint in fingerprints:
+        row = None if cache is None else cache.get(month, fingerprint)
+        if row is None:
+            if payments_by_entity is None:
+                payments_by_entity = Supporter.load_payments(end_month)
+            row = report_month(month, payments_by_entity)
+            if cache is not None:
+                cache.put(month, fingerprint, row)
+        yield row
 
 def main(arglist):
     args = parse_arguments(arglist)
+    cache = ReportCache(args.cache) if args.cache else None
     out_csv = csv.writer(sys.stdout)
     # NOTE: 'Total New' here is the same as 'Total New' from status_report.py
     out_csv.writerow((
@@ -64,10 +171,7 @@ def main(arglist):
         'Were 0-3mo expired', 'Were 3-6mo expired', 'Were 6-9mo expired',
         'Were 9-12mo expired', 'Were >1yr expired'
     ))
-    month = Date.from_pydate(args.start_month)
-    while month <= args.end_month:
-        out_csv.writerow(report_month(month))
-        month = month.round_month_up()
+    out_csv.writerows(iter_report_rows(args.start_month, args.end_month, cache))
 
 if __name__ == '__main__':
     main(None)
@@ -12,6 +12,7 @@ import django
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'supporters.settings')
 django.setup()
+from django.db import models
 from supporters.models import Date, Payment, Supporter
 
 MONTH_FMT = '%Y-%m'
@@ -22,15 +23,20 @@ def parse_arguments(arglist):
         description="Print a CSV report counting Supporters over time",
     )
     month_date = functools.partial(Date.strptime, fmt=MONTH_FMT)
+    first_payment_date = Payment.objects.aggregate(first=models.Min('date'))['first']
+    if first_payment_date is not None:
+        first_payment_date = Date.from_pydate(first_payment_date)
     parser.add_argument(
         '--start-month', type=month_date, metavar='YYYY-MM',
-        default=Payment.objects.order_by('date').first().date,
+        default=first_payment_date,
         help="First month in report")
     parser.add_argument(
         '--end-month', type=month_date, metavar='YYYY-MM',
         default=Date.today(),
         help="Last month in report")
     args = parser.parse_args(arglist)
+    if args.start_month is None:
+        parser.error("No payments loaded; --start-month is required")
     if args.end_month < args.start_month:
         parser.error("End month predates start month")
     return args
@@ -1,33 +1,35 @@
 #!/usr/bin/env python3
 
+import bisect
+import collections
 import datetime
+import functools
+import itertools
 import operator
+import re
 import time
 
 from django.db import models
 
 class Date(datetime.date):
-    MONTH_MAXDAY = {
-        1: 31,
-        2: 28,
-        3: 31,
-        4: 30,
-        5: 31,
-        6: 30,
-        7: 31,
-        8: 31,
-        9: 30,
-        10: 31,
-        11: 30,
-        12: 31,
-    }
+    # Indexed by month number; there is no month 0.
+    MONTH_MAXDAY = (0, 31, 28, 31, 30, 31, 30, 31, 31, 30, 31, 30, 31)
 
     @classmethod
     def from_pydate(cls, date):
         return cls(date.year, date.month, date.day)
 
+    YEAR_MONTH_RE = re.compile(r'([0-9]{4})-([0-9]{1,2})')
+
     @classmethod
     def strptime(cls, s, fmt):
+        # Reports parse YYYY-MM arguments; skip time.strptime's general,
+        # locale-aware parser for them.
+        if fmt == '%Y-%m':
+            match = cls.YEAR_MONTH_RE.fullmatch(s)
+            if match is None:
+                raise ValueError("time data %r does not match format %r" % (s, fmt))
+            return cls(int(match.group(1)), int(match.group(2)), 1)
         time_tuple = time.strptime(s, fmt)
         return cls(*time_tuple[:3])
 
@@ -44,14 +46,27 @@ class Date(datetime.date):
         day = min(day, self.MONTH_MAXDAY[month])
         return type(self)(year, month, day)
 
+    # These are equivalent to adjust_month(1, day), adjust_month(12), and
+    # adjust_month(1, day=1), without its general-purpose arithmetic.
     def next_month(self, day=None):
-        return self.adjust_month(1, day)
+        if day is None:
+            day = self.day
+        if self.month == 12:
+            year, month = self.year + 1, 1
+        else:
+            year, month = self.year, self.month + 1
+        return type(self)(year, month, min(day, self.MONTH_MAXDAY[month]))
 
     def next_year(self):
-        return self.adjust_month(12)
+        return type(self)(self.year + 1, self.month,
+                          min(self.day, self.MONTH_MAXDAY[self.month]))
 
     def round_month_up(self):
-        return self.adjust_month(1, day=1)
+        return type(self)(self.year + (self.month == 12), self.month % 12 + 1, 1)
+
+    # Months since the start of year 0, for month arithmetic on plain ints.
+    def month_index(self):
+        return 12 * self.year + self.month - 1
 
 
 class DateField(models.DateField):
@@ -62,12 +77,15 @@ class DateField(models.DateField):
 
 
 class Payment(models.Model):
-    date = DateField()
+    date = DateField(db_index=True)
     entity = models.TextField()
     payee = models.TextField()
     program = models.TextField()
     amount = models.TextField()
 
+    class Meta:
+        index_together = [('entity', 'date')]
+
 
 class Supporter:
     STATUS_NEW = 'New'
@@ -81,26 +99,19 @@ class Supporter:
     def __init__(self, entity):
         self.entity = entity
 
+    @classmethod
+    def clear_cache(cls):
+        _iter_entities_cached.cache_clear()
+        _payment_snapshot.cache_clear()
+
     @classmethod
     def iter_entities(cls, supporter_types=['Annual', 'Monthly']):
-        qset = Payment.objects.only('entity')
-        if supporter_types is None:
-            pass
-        elif not supporter_types:
-            qset = qset.none()
-        else:
-            condition = models.Q()
-            for suffix in supporter_types:
-                condition |= models.Q(program__endswith=':' + suffix)
-            qset = qset.filter(condition)
-        seen = set()
-        for payment in qset:
-            if payment.entity not in seen:
-                seen.add(payment.entity)
-                yield payment.entity
+        if supporter_types is not None:
+            supporter_types = frozenset(supporter_types)
+        return iter(_iter_entities_cached(supporter_types))
 
     def payments(self, as_of_date=None):
-        pset = Payment.objects.order_by('date').filter(entity=self.entity)
+        pset = Payment.objects.order_by('date', 'id').filter(entity=self.entity)
         if as_of_date is not None:
             pset = pset.filter(date__lte=as_of_date)
         return pset
@@ -119,59 +130,60 @@ class Supporter:
             return program.rsplit(':', 1)[-1]
     supporter_type = _expose(_supporter_type)
 
-    def _calculate_lapse_date(self, last_payment_date, supporter_type):
-        if supporter_type == 'Monthly':
-            lapse_date = last_payment_date.next_month()
-        else:
-            lapse_date = last_payment_date.next_year()
-        return lapse_date.round_month_up()
+    @staticmethod
+    def _lapse_month_index(month_index, supporter_type):
+        # Monthly supporters lapse on the first of the second month after
+        # their last payment; everyone else on the first of the month after
+        # its anniversary.
+        return month_index + (2 if supporter_type == 'Monthly' else 13)
+
+    @classmethod
+    def calculate_lapse_date(cls, last_payment_date, supporter_type):
+        year, month = divmod(
+            cls._lapse_month_index(last_payment_date.month_index(), supporter_type), 12)
+        return type(last_payment_date)(year, month + 1, 1)
 
     def _lapse_date(self, payments):
-        return self._calculate_lapse_date(payments.last().date,
-                                          self._supporter_type(payments))
+        last_date = payments.aggregate(last=models.Max('date'))['last']
+        return self.calculate_lapse_date(Date.from_pydate(last_date),
+                                         self._supporter_type(payments))
     lapse_date = _expose(_lapse_date)
 
-    def _second_last_lapse_date(self, payments):
-        # TODO: find a way without listification - needed due to indexing
-        return self._calculate_lapse_date(list(payments)[-2].date,
-                                          self._supporter_type(payments))
+    def _snapshot(self, as_of_date):
+        return _payment_snapshot(self.entity, as_of_date)
 
-    def status(self, as_of_date=None):
-        if as_of_date is None:
-            as_of_date = Date.today()
-        payments = self.payments(as_of_date)
-        payments_count = payments.count()
-        if payments_count == 0:
+    @classmethod
+    def _snapshot_status(cls, snapshot, as_of_date):
+        if not snapshot.count:
             return None
-        lapse_date = self._lapse_date(payments)
+        lapse_date = cls.calculate_lapse_date(snapshot.last_date,
+                                              snapshot.supporter_type)
         days_past_due = as_of_date - lapse_date
-        if days_past_due >= self.LOST_THRESHOLD:
-            return self.STATUS_LOST
-        elif days_past_due >= self.LAPSED_THRESHOLD:
-            return self.STATUS_LAPSED
-        elif as_of_date.adjust_month(-1, 1) < payments.first().date <= as_of_date:
-            return self.STATUS_NEW
+        if days_past_due >= cls.LOST_THRESHOLD:
+            return cls.STATUS_LOST
+        elif days_past_due >= cls.LAPSED_THRESHOLD:
+            return cls.STATUS_LAPSED
+        elif _period_start(as_of_date) < snapshot.first_date <= as_of_date:
+            return cls.STATUS_NEW
         else:
-            return self.STATUS_ACTIVE
+            return cls.STATUS_ACTIVE
 
-    def months_expired_at_return(self, as_of_date=None):
-        if as_of_date is None:
-            as_of_date = Date.today()
-        payments = self.payments(as_of_date)
-        payments_count = payments.count()
-        if payments_count == 0:
+    @classmethod
+    def _snapshot_months_expired(cls, snapshot, as_of_date):
+        if not snapshot.count:
             return 0
-        lapse_date = self._lapse_date(payments)
-        days_past_due = as_of_date - lapse_date
 
-        if as_of_date.adjust_month(-1, 1) < payments.first().date <= as_of_date:
+        if _period_start(as_of_date) < snapshot.first_date <= as_of_date:
             return 0  # started paying this month so not "returning"
 
-        elif as_of_date.adjust_month(-1, 1) < payments.last().date <= as_of_date:
-            # (there are at least 2 payments because first().date != last().date)
-            past_lapse_date = self._second_last_lapse_date(payments)
+        elif _period_start(as_of_date) < snapshot.last_date <= as_of_date:
+            # (there are at least 2 payments because first_date != last_date)
+            # The lapse date for the second-last payment is the first of this month.
+            past_lapse_month = cls._lapse_month_index(snapshot.second_last_month,
+                                                      snapshot.supporter_type)
+            months_late = snapshot.last_month - past_lapse_month
 
-            if payments.last().date <= past_lapse_date:
+            if (months_late < 0) or (months_late == 0 and snapshot.last_date.day == 1):
                 # the most recent payment was this month, and it was before or on
                 #  the lapse date for the last payment (i.e. it was "on-time") so
                 #  this is a normal active subscriber, not a "re-"subscriber
@@ -182,8 +194,135 @@ class Supporter:
                 #  know the supporter paid after the lapse date, add one to the
                 #  result because paying in the same month still means they lapsed -
                 #  this effectively means the result is the ceiling of months lapsed
-                return ((12 * payments.last().date.year + payments.last().date.month)
-                        - (12 * past_lapse_date.year + past_lapse_date.month)) + 1
+                return months_late + 1
         else:
             # supporter lapsed/lost or an annual supporter who paid 2-12 months ago
             return 0
+
+    def status(self, as_of_date=None):
+        if as_of_date is None:
+            as_of_date = Date.today()
+        return self._snapshot_status(self._snapshot(as_of_date), as_of_date)
+
+    def months_expired_at_return(self, as_of_date=None):
+        if as_of_date is None:
+            as_of_date = Date.today()
+        return self._snapshot_months_expired(self._snapshot(as_of_date), as_of_date)
+
+    @classmethod
+    def load_payments(cls, as_of_date=None):
+        # Load everybody's payments with one query, for status_for_all.
+        # Each entity maps to a (dates, months, supporter_types) tuple of
+        # lists sorted by payment date: the dates of its payments, their
+        # month_index() values, and its supporter type as of each payment.
+        payments = Payment.objects.order_by('entity', 'date', 'id')
+        if as_of_date is not None:
+            payments = payments.filter(date__lte=as_of_date)
+        payments = payments.values_list('entity', 'date', 'program')
+        payments_by_entity = {}
+        for entity, rows in itertools.groupby(payments, operator.itemgetter(0)):
+            dates = []
+            months = []
+            supporter_types = []
+            supporter_type = None
+            for _, date, program in rows:
+                if program is not None:
+                    supporter_type = program.rsplit(':', 1)[-1]
+                dates.append(date)
+                months.append(date.month_index())
+                supporter_types.append(supporter_type)
+            payments_by_entity[entity] = (dates, months, supporter_types)
+        return payments_by_entity
+
+    @classmethod
+    def status_for_all(cls, as_of_date=None, payments_by_entity=None):
+        # Return a dict mapping each entity with payments as of as_of_date to
+        # its SupporterStatus.  Reports that cover several dates can load
+        # payments once and pass the result of load_payments() to each call.
+        if as_of_date is None:
+            as_of_date = Date.today()
+        if payments_by_entity is None:
+            payments_by_entity = cls.load_payments(as_of_date)
+        statuses = {}
+        for entity, (dates, months, supporter_types) in payments_by_entity.items():
+            count = bisect.bisect_right(dates, as_of_date)
+            if count == 0:
+                continue
+            snapshot = PaymentSnapshot(
+                count=count,
+                first_date=dates[0],
+                last_date=dates[count - 1],
+                second_last_date=dates[count - 2] if count > 1 else None,
+                last_month=months[count - 1],
+                second_last_month=months[count - 2] if count > 1 else None,
+                supporter_type=supporter_types[count - 1],
+            )
+            statuses[entity] = SupporterStatus(
+                snapshot.supporter_type,
+                cls._snapshot_status(snapshot, as_of_date),
+                cls._snapshot_months_expired(snapshot, as_of_date),
+            )
+        return statuses
+
+
+# Reports ask for the same entity lists every month they cover.
+@functools.lru_cache(maxsize=None)
+def _iter_entities_cached(supporter_types):
+    qset = Payment.objects.all()
+    if supporter_types is None:
+        pass
+    elif not supporter_types:
+        qset = qset.none()
+    else:
+        condition = models.Q()
+        for suffix in supporter_types:
+            condition |= models.Q(program__endswith=':' + suffix)
+        qset = qset.filter(condition)
+    return tuple(qset.values_list('entity', flat=True).distinct())
+
+PaymentSnapshot = collections.namedtuple('PaymentSnapshot', [
+    'count', 'first_date', 'last_date', 'second_last_date',
+    'last_month', 'second_last_month', 'supporter_type',
+])
+
+SupporterStatus = collections.namedtuple('SupporterStatus', [
+    'supporter_type', 'status', 'months_expired',
+])
+
+# Every supporter's status is checked against the same few dates.
+@functools.lru_cache(maxsize=256)
+def _period_start(as_of_date):
+    return as_of_date.adjust_month(-1, 1)
+
+# status() and months_expired_at_return() are usually called back-to-back
+# with the same arguments, so remember what recent queries found.  Reports
+# rarely come back to older dates, so there's no use keeping everything.
+@functools.lru_cache(maxsize=4096)
+def _payment_snapshot(entity, as_of_date):
+    payments = list(Supporter(entity).payments(as_of_date)
+                    .values_list('date', 'program'))
+    if not payments:
+        return PaymentSnapshot(0, None, None, None, None, None, None)
+    supporter_type = None
+    for date, program in reversed(payments):
+        if program is not None:
+            supporter_type = program.rsplit(':', 1)[-1]
+            break
+    last_date = payments[-1][0]
+    second_last_date = payments[-2][0] if len(payments) > 1 else None
+    return PaymentSnapshot(
+        count=len(payments),
+        first_date=payments[0][0],
+        last_date=last_date,
+        second_last_date=second_last_date,
+        last_month=last_date.month_index(),
+        second_last_month=(None if second_last_date is None
+                           else second_last_date.month_index()),
+        supporter_type=supporter_type,
+    )
+
+# Payment data changing in this process invalidates anything we remember.
+def _clear_supporter_cache(sender, **kwargs):
+    Supporter.clear_cache()
+models.signals.post_save.connect(_clear_supporter_cache, sender=Payment)
+models.signals.post_delete.connect(_clear_supporter_cache, sender=Payment)